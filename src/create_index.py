@@ -1,3 +1,4 @@
+import json
 import re
 from textwrap import dedent
 from typing import TypedDict
@@ -110,9 +111,19 @@ class Package(TypedDict):
     file_name: str
     sha256: str
     version: str
+    depends: list[str]
     releases: list[ReleaseInfo]
 
 
+class LinkInfo(TypedDict):
+    filename: str
+    url: str
+
+
+def canonicalize_package_infos(packages: dict[str, Package]) -> dict[str, Package]:
+    return {canonicalize_name(k): v for (k, v) in packages.items()}
+
+
 def create_top_level_index(
     version: str, packages: dict[str, Package]
 ) -> tuple[str, str]:
@@ -134,20 +145,71 @@ def create_top_level_index(
     )
 
 
-def create_package_index(version: str, dist_url, pkginfo: Package) -> tuple[str, str]:
+def create_dependency_graph(packages: dict[str, Package]) -> dict[str, list[str]]:
+    # Map each package name to the canonical names of its direct dependencies.
+    # The keys of packages are expected to be canonical already.
+    return {
+        pkgname: [canonicalize_name(dep) for dep in pkginfo["depends"]]
+        for (pkgname, pkginfo) in packages.items()
+    }
+
+
+def dependency_closure(graph: dict[str, list[str]], name: str) -> list[str]:
+    # Breadth first, so the requested package comes first. Dependencies missing
+    # from the graph are skipped.
+    closure = [name]
+    seen = {name}
+    for pkgname in closure:
+        for dep in graph.get(pkgname, []):
+            if dep in seen or dep not in graph:
+                continue
+            seen.add(dep)
+            closure.append(dep)
+    return closure
+
+
+def create_package_links(dist_url: str, pkginfo: Package) -> list[LinkInfo]:
     filename = pkginfo["file_name"]
     if urlparse(filename).scheme:
         href = filename
     else:
         shasum = pkginfo["sha256"]
         href = f"{dist_url}{filename}#sha256={shasum}"
-    links = [f'<a href="{href}">{filename}</a>\n']
+    links = [LinkInfo(filename=filename, url=href)]
     for release in pkginfo["releases"]:
         shasum = release["digests"]["sha256"]
         href = release["url"]
-        links.append(f'<a href="{href}#sha256={shasum}">{release["filename"]}</a>')
+        links.append(
+            LinkInfo(filename=release["filename"], url=f"{href}#sha256={shasum}")
+        )
+    return links
+
+
+def create_package_index(version: str, dist_url, pkginfo: Package) -> tuple[str, str]:
+    links = [
+        f'<a href="{link["url"]}">{link["filename"]}</a>'
+        for link in create_package_links(dist_url, pkginfo)
+    ]
+    links[0] += "\n"
     pkgname = canonicalize_name(pkginfo["name"])
     file_html = FILE_TEMPLATE.format(
         version=version, pkgname=pkgname, links="\n".join(links)
     )
     return (f"/{version}/{pkgname}/index.html", file_html)
+
+
+def create_closure_index(
+    version: str, dist_url: str, name: str, pkginfos: list[Package]
+) -> tuple[str, str]:
+    packages = {
+        canonicalize_name(pkginfo["name"]): {
+            "version": pkginfo["version"],
+            "depends": [canonicalize_name(dep) for dep in pkginfo["depends"]],
+            "links": create_package_links(dist_url, pkginfo),
+        }
+        for pkginfo in pkginfos
+    }
+    return (
+        f"/{version}/_closure/{name}",
+        json.dumps({"version": version, "name": name, "packages": packages}),
+    )
@@ -8,47 +8,58 @@ from workers import Response, WorkerEntrypoint, fetch
 
 from create_index import (
     Package,
-    ReleaseInfo,
     canonicalize_name,
+    canonicalize_package_infos,
+    create_closure_index,
+    create_dependency_graph,
     create_package_index,
     create_top_level_index,
+    dependency_closure,
     make_root_index_page,
 )
 
 DIST_TEMPLATE = "https://cdn.jsdelivr.net/pyodide/v{}/full/"
 
+# Cloudflare KV accepts at most this many keys in a single bulk get.
+KV_GET_LIMIT = 100
+
 @cache
-def get_headers():
+def get_headers(content_type: str = "text/html"):
     return Headers.new(
         [
             ("access-control-allow-origin", "*"),
             ("access-control-expose-headers", "*"),
-            ("content-type", "text/html"),
+            ("content-type", content_type),
         ]
     )
 
+
 ROBOTS_TEXT = """\
 User-agent: *
 Allow: /
 """
 
 
-async def fetch_pypi_metadata(pkg: Package) -> ReleaseInfo:
+async def fetch_pypi_metadata(pkg: Package) -> bool:
+    # Returns False if PyPI didn't give a definite answer, in which case the
+    # empty release list shouldn't be cached. A 404 just means the package
+    # isn't on PyPI.
     resp = await fetch(f"https://pypi.org/pypi/{pkg['name']}/json")
     if resp.status >= 400:
         pkg["releases"] = []
-        return
+        return resp.status == 404
     info = await resp.json()
     try:
         releases = info["releases"][pkg["version"]]
     except KeyError:
         pkg["releases"] = []
-        return
+        return True
     pkg["releases"] = releases
+    return True
 
 
-async def fetch_pypi_metadatas(pkgs: list[Package]) -> dict[str, ReleaseInfo]:
-    await gather(*(fetch_pypi_metadata(pkg) for pkg in pkgs))
+async def fetch_pypi_metadatas(pkgs: list[Package]) -> list[bool]:
+    return await gather(*(fetch_pypi_metadata(pkg) for pkg in pkgs))
 
 
 async def fetch_package_info(version) -> dict[str, Package]:
@@ -63,11 +74,86 @@ async def fetch_package_info(version) -> dict[str, Package]:
 class Default(WorkerEntrypoint):
     async def cache_package_infos(
         self, version: str, pkg_infos: dict[str, Package]
-    ) -> str:
+    ) -> tuple[dict[str, Package], str]:
+        pkg_infos = canonicalize_package_infos(pkg_infos)
         await self.env.index_cache.put(version, json.dumps(pkg_infos))
         k, v = create_top_level_index(version, pkg_infos)
         await self.env.index_cache.put(k, v)
-        return v
+        return pkg_infos, v
+
+    async def get_many(self, keys: list[str]) -> dict[str, str | None]:
+        chunks = [
+            keys[i : i + KV_GET_LIMIT] for i in range(0, len(keys), KV_GET_LIMIT)
+        ]
+        results = await gather(
+            *(self.env.index_cache.get(Array.new(*chunk)) for chunk in chunks)
+        )
+        return {
+            key: result[key]
+            for (chunk, result) in zip(chunks, results)
+            for key in chunk
+        }
+
+    async def load_releases(self, version: str, pkgs: list[Package]) -> bool:
+        # Release lists are cached per package so that closures which share
+        # dependencies only ask PyPI about each package once. Returns False if
+        # any of them couldn't be fetched.
+        keys = [
+            f"{version}:{canonicalize_name(pkg['name'])}:releases" for pkg in pkgs
+        ]
+        result = await self.get_many(keys)
+        missing = []
+        for pkg, key in zip(pkgs, keys):
+            if releases := result[key]:
+                pkg["releases"] = json.loads(releases)
+            else:
+                missing.append((pkg, key))
+        if not missing:
+            return True
+        print("... Fetching pypi info for", len(missing), "packages")
+        ok = await fetch_pypi_metadatas([pkg for (pkg, _) in missing])
+        await gather(
+            *(
+                self.env.index_cache.put(key, json.dumps(pkg["releases"]))
+                for ((pkg, key), fetched) in zip(missing, ok)
+                if fetched
+            )
+        )
+        return all(ok)
+
+    async def fetch_closure(self, version: str, name: str):
+        canonicalized_name = canonicalize_name(name)
+        closure_key = f"/{version}/_closure/{canonicalized_name}"
+        result = await self.env.index_cache.get(Array.new(version, closure_key))
+        if content := result[closure_key]:
+            print("... Found result in cache")
+            return Response(content, headers=get_headers("application/json"))
+        pkg_infos: dict[str, Package]
+        if result[version]:
+            print("... Found lock info in cache")
+            # Lock info cached by older versions of the worker may have
+            # non-canonical keys.
+            pkg_infos = canonicalize_package_infos(json.loads(result[version]))
+        else:
+            print("... Fetching lock info")
+            pkg_infos, _ = await self.cache_package_infos(
+                version, await fetch_package_info(version)
+            )
+
+        if canonicalized_name not in pkg_infos:
+            return Response("Not found", status=404)
+
+        graph = create_dependency_graph(pkg_infos)
+        closure = [
+            pkg_infos[pkgname]
+            for pkgname in dependency_closure(graph, canonicalized_name)
+        ]
+        complete = await self.load_releases(version, closure)
+        dist_url = DIST_TEMPLATE.format(version)
+        k, v = create_closure_index(version, dist_url, canonicalized_name, closure)
+        if complete:
+            await self.env.index_cache.put(k, v)
+        return Response(v, headers=get_headers("application/json"))
 
     async def fetch(self, request):
         path = urlparse(request.url).path
@@ -82,6 +168,10 @@ class Default(WorkerEntrypoint):
         if path.startswith("/simple-index/"):
             path = path.removeprefix("/simple-index/")
 
+        match path.strip("/").split("/"):
+            case [version, "_closure", name]:
+                return await self.fetch_closure(version, name)
+
         if not path.endswith("/index.html") and not path.endswith("/"):
             path += "/"
         if path.endswith("/"):
@@ -113,8 +203,9 @@ class Default(WorkerEntrypoint):
             pkg_infos = json.loads(result[version])
         else:
             print("... Fetching lock info")
-            pkg_infos = await fetch_package_info(version)
-            v = await self.cache_package_infos(version, pkg_infos)
+            pkg_infos, v = await self.cache_package_infos(
+                version, await fetch_package_info(version)
+            )
             if name == "index.html":
                 # Return top level index
                 return Response(v, headers=get_headers())
@@ -39,11 +39,11 @@ class Headers(UserDict):
 
 @dataclass
 class Response:
-    def new(arg, *, headers=None):
+    def new(arg, *, headers=None, status=200):
         if headers is None:
             headers = {}
         if isinstance(arg, str):
-            return Response(arg, headers=Headers(headers.items()))
+            return Response(arg, status=status, headers=Headers(headers.items()))
         return arg
 
     body: str
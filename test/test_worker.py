@@ -1,3 +1,4 @@
+import json
 from dataclasses import dataclass, field
 
 import pytest
@@ -18,6 +19,8 @@ class KV:
         if isinstance(k, str):
             return self.data.get(k)
         if isinstance(k, list):
+            # Cloudflare rejects bulk gets of more than 100 keys
+            assert len(k) <= 100
             return {key: self.data.get(key) for key in k}
 
     async def put(self, key, value):
@@ -111,6 +114,30 @@ async def test_version_index(package_json, url: str, capsys):
     assert "Found result in cache" in io.out
 
 
+@pytest.mark.asyncio
+async def test_version_index_canonical_names(httpx_mock: HTTPXMock):
+    packages = {
+        "affine": AFFINE_JSDELIVR_INFO,
+        "pydantic_core": PYDANTIC_CORE_JSDELIVR_INFO,
+    }
+    httpx_mock.add_response(
+        method="GET",
+        url="https://cdn.jsdelivr.net/pyodide/v0.28.3/full/pyodide-lock.json",
+        json={"packages": packages},
+    )
+    worker = Default(Ctx, Env())
+    result = await worker.fetch(Request("/0.28.3"))
+    parsed = BeautifulSoup(result.body, "html.parser")
+    all_links = parsed.find_all("a")
+    assert len(all_links) == 2
+    assert all_links[1].text == "pydantic-core"
+    assert all_links[1]["href"] == "0.28.3/pydantic-core/"
+    assert list(json.loads(worker.env.index_cache.data["0.28.3"]).keys()) == [
+        "affine",
+        "pydantic-core",
+    ]
+
+
 @pytest.mark.asyncio
 async def test_package_info(package_json, httpx_mock: HTTPXMock, capsys):
     json = {
@@ -256,3 +283,192 @@ async def test_canonicalize_package_name2(package_json, httpx_mock: HTTPXMock, c
     assert "Fetching lock info" not in io.out
     assert "Fetching pypi info for pydantic-core" not in io.out
     assert "Found result in cache" in io.out
+
+
+RASTERIO_JSDELIVR_INFO = {
+    "file_name": "rasterio-1.4.3-cp313-cp313-pyodide_2025_0_wasm32.whl",
+    "install_dir": "site",
+    "name": "rasterio",
+    "package_type": "package",
+    "sha256": "5b2b5d5c2e1c4c52ed1b1bd35e9a3ad7a4b08e4ba6bcfaf1c8a3e7a0f9c3c3d1",
+    "version": "1.4.3",
+}
+
+
+@pytest.fixture
+def closure_packages():
+    # The lock file key for pydantic_core is deliberately not canonical, and
+    # the depends entries use both spellings.
+    return {
+        "rasterio": {
+            **RASTERIO_JSDELIVR_INFO,
+            "depends": ["affine", "pydantic_core", "not-in-lock"],
+        },
+        "affine": {**AFFINE_JSDELIVR_INFO, "depends": ["pydantic-core"]},
+        "pydantic_core": {**PYDANTIC_CORE_JSDELIVR_INFO, "depends": []},
+    }
+
+
+@pytest.fixture
+def closure_package_json(httpx_mock: HTTPXMock, closure_packages):
+    httpx_mock.add_response(
+        method="GET",
+        url="https://cdn.jsdelivr.net/pyodide/v0.28.3/full/pyodide-lock.json",
+        json={"packages": closure_packages},
+    )
+
+
+def add_empty_pypi_responses(httpx_mock: HTTPXMock, names: list[str]):
+    for name in names:
+        httpx_mock.add_response(
+            method="GET",
+            url=f"https://pypi.org/pypi/{name}/json",
+            json={"releases": {}},
+        )
+
+
+@pytest.mark.asyncio
+async def test_closure(closure_package_json, httpx_mock: HTTPXMock, capsys):
+    add_empty_pypi_responses(httpx_mock, ["rasterio", "affine", "pydantic_core"])
+    worker = Default(Ctx, Env())
+    result = await worker.fetch(Request("/0.28.3/_closure/Rasterio"))
+    closure = json.loads(result.body)
+    assert closure["name"] == "rasterio"
+    assert list(closure["packages"].keys()) == ["rasterio", "affine", "pydantic-core"]
+    assert closure["packages"]["rasterio"]["depends"] == [
+        "affine",
+        "pydantic-core",
+        "not-in-lock",
+    ]
+    affine = closure["packages"]["affine"]
+    assert affine["depends"] == ["pydantic-core"]
+    assert affine["links"] == [
+        {
+            "filename": AFFINE_JSDELIVR_INFO["file_name"],
+            "url": f"https://cdn.jsdelivr.net/pyodide/v0.28.3/full/{AFFINE_JSDELIVR_INFO['file_name']}#sha256={AFFINE_JSDELIVR_INFO['sha256']}",
+        }
+    ]
+    assert list(worker.env.index_cache.data.keys()) == [
+        "0.28.3",
+        "/0.28.3/index.html",
+        "0.28.3:rasterio:releases",
+        "0.28.3:affine:releases",
+        "0.28.3:pydantic-core:releases",
+        "/0.28.3/_closure/rasterio",
+    ]
+    io = capsys.readouterr()
+    assert "Fetching lock info" in io.out
+    assert "Fetching pypi info for 3 packages" in io.out
+
+    result2 = await worker.fetch(Request("/0.28.3/_closure/rasterio"))
+    assert result2.body == result.body
+    io = capsys.readouterr()
+    assert "Fetching lock info" not in io.out
+    assert "Fetching pypi info" not in io.out
+    assert "Found result in cache" in io.out
+
+
+@pytest.mark.asyncio
+async def test_closure_unknown_package(closure_package_json):
+    worker = Default(Ctx, Env())
+    result = await worker.fetch(Request("/0.28.3/_closure/not-in-lock"))
+    assert result.status == 404
+    assert list(worker.env.index_cache.data.keys()) == [
+        "0.28.3",
+        "/0.28.3/index.html",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_closure_cached_lock_info(
+    closure_packages, httpx_mock: HTTPXMock, capsys
+):
+    # Simulate a lock file cached by an older worker, which stored the lock
+    # file keys as is, along with the release list for pydantic-core cached by
+    # an earlier closure.
+    env = Env()
+    env.index_cache.data["0.28.3"] = json.dumps(closure_packages)
+    env.index_cache.data["0.28.3:pydantic-core:releases"] = json.dumps([])
+    add_empty_pypi_responses(httpx_mock, ["affine"])
+    worker = Default(Ctx, env)
+
+    result = await worker.fetch(Request("/0.28.3/_closure/affine"))
+    closure = json.loads(result.body)
+    assert list(closure["packages"].keys()) == ["affine", "pydantic-core"]
+    io = capsys.readouterr()
+    assert "Found lock info in cache" in io.out
+    assert "Fetching lock info" not in io.out
+    assert "Fetching pypi info for 1 packages" in io.out
+
+    # rasterio spells the shared dependency pydantic_core; both its
+    # dependencies' release lists are already cached.
+    add_empty_pypi_responses(httpx_mock, ["rasterio"])
+    result = await worker.fetch(Request("/0.28.3/_closure/rasterio"))
+    closure = json.loads(result.body)
+    assert list(closure["packages"].keys()) == ["rasterio", "affine", "pydantic-core"]
+    io = capsys.readouterr()
+    assert "Found lock info in cache" in io.out
+    assert "Fetching pypi info for 1 packages" in io.out
+    assert list(worker.env.index_cache.data.keys()) == [
+        "0.28.3",
+        "0.28.3:pydantic-core:releases",
+        "0.28.3:affine:releases",
+        "/0.28.3/_closure/affine",
+        "0.28.3:rasterio:releases",
+        "/0.28.3/_closure/rasterio",
+    ]
+
+    result = await worker.fetch(Request("/0.28.3/_closure/pydantic_core"))
+    closure = json.loads(result.body)
+    assert list(closure["packages"].keys()) == ["pydantic-core"]
+    io = capsys.readouterr()
+    assert "Fetching pypi info" not in io.out
+
+
+@pytest.mark.asyncio
+async def test_closure_pypi_error(closure_package_json, httpx_mock: HTTPXMock, capsys):
+    add_empty_pypi_responses(httpx_mock, ["pydantic_core"])
+    httpx_mock.add_response(
+        method="GET", url="https://pypi.org/pypi/affine/json", status_code=503
+    )
+    worker = Default(Ctx, Env())
+    result = await worker.fetch(Request("/0.28.3/_closure/affine"))
+    closure = json.loads(result.body)
+    assert list(closure["packages"].keys()) == ["affine", "pydantic-core"]
+    # Neither the failed release list nor the incomplete closure are cached
+    assert list(worker.env.index_cache.data.keys()) == [
+        "0.28.3",
+        "/0.28.3/index.html",
+        "0.28.3:pydantic-core:releases",
+    ]
+    io = capsys.readouterr()
+    assert "Fetching pypi info for 2 packages" in io.out
+
+    add_empty_pypi_responses(httpx_mock, ["affine"])
+    result = await worker.fetch(Request("/0.28.3/_closure/affine"))
+    io = capsys.readouterr()
+    assert "Fetching pypi info for 1 packages" in io.out
+    assert "/0.28.3/_closure/affine" in worker.env.index_cache.data
+
+
+@pytest.mark.asyncio
+async def test_closure_large(httpx_mock: HTTPXMock):
+    names = [f"pkg{i}" for i in range(150)]
+    packages = {
+        name: {
+            **AFFINE_JSDELIVR_INFO,
+            "name": name,
+            "depends": names[i + 1 : i + 2],
+        }
+        for (i, name) in enumerate(names)
+    }
+    httpx_mock.add_response(
+        method="GET",
+        url="https://cdn.jsdelivr.net/pyodide/v0.28.3/full/pyodide-lock.json",
+        json={"packages": packages},
+    )
+    add_empty_pypi_responses(httpx_mock, names)
+    worker = Default(Ctx, Env())
+    result = await worker.fetch(Request("/0.28.3/_closure/pkg0"))
+    closure = json.loads(result.body)
+    assert list(closure["packages"].keys()) == names